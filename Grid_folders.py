@@ -8,52 +8,114 @@ Output: /mnt/data/GridCells/cell_<cell_id>/
 
 import json
 import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
 
+from grid_utils import jdumps
+
+try:
+    import ijson
+except ImportError:  # fall back to loading the whole file
+    ijson = None
+
 # -------- Configuration --------
 INPUT_FILE = Path("/datassd4_8tb/p2t4_common_data/pushpita/GridApplication/Grid_metric.geojson")
 OUTPUT_ROOT = Path("/datassd4_8tb/p2t4_common_data/datassd4_8tb/p2t4_common_data/Grid_folder")   # parent directory for all folders
 KEY_NAME = "cell_id"   # change to "cell_no" if your file uses that field name
+BATCH_SIZE = 1000      # features handed to a worker at a time
+MAX_WORKERS = os.cpu_count() or 1
 # --------------------------------
 
+def iter_features(path: Path):
+    """Yield features one at a time (streamed with ijson when installed, so memory stays O(one feature))."""
+    if ijson is None:
+        yield from json.loads(path.read_text()).get("features", [])
+        return
+    with path.open("rb") as f:
+        yield from ijson.items(f, "features.item", use_float=True)
+
+def write_cell_batch(root: Path, batch: list[tuple[str, dict]], input_mtime: float) -> tuple[int, int]:
+    """
+    Worker: create each cell folder and write its single-feature GeoJSON.
+    Files newer than the input, or whose bytes would not change, are not rewritten (the latter are only touched).
+    Returns (folders created, files skipped).
+    """
+    skipped = 0
+    for folder_name, feat in batch:
+        folder_path = root / folder_name
+        folder_path.mkdir(exist_ok=True)
+        single_path = folder_path / f"{folder_name}.geojson"
+        try:
+            old_stat = single_path.stat()
+        except FileNotFoundError:
+            old_stat = None
+        if old_stat is not None and old_stat.st_mtime >= input_mtime:
+            skipped += 1
+            continue
+
+        # Optional: write this feature's geometry into its folder as GeoJSON
+        single_feat = {
+            "type": "FeatureCollection",
+            "features": [feat]
+        }
+        new_bytes = jdumps(single_feat)
+        if old_stat is not None and old_stat.st_size == len(new_bytes) and single_path.read_bytes() == new_bytes:
+            os.utime(single_path)  # mark as current so later runs take the mtime fast path
+            skipped += 1
+            continue
+        single_path.write_bytes(new_bytes)
+    return len(batch), skipped
+
 def main():
     # Load GeoJSON
     if not INPUT_FILE.exists():
         raise FileNotFoundError(f"GeoJSON not found at {INPUT_FILE}")
-    print(f"[INFO] Reading GeoJSON from {INPUT_FILE}")
-    data = json.loads(INPUT_FILE.read_text())
-    features = data.get("features", [])
-    print(f"[INFO] Found {len(features)} features")
+    print(f"[INFO] Streaming GeoJSON features from {INPUT_FILE}")
 
     # Ensure output directory exists
     OUTPUT_ROOT.mkdir(parents=True, exist_ok=True)
 
     created = 0
+    skipped = 0
     missing_id = 0
+    input_mtime = INPUT_FILE.stat().st_mtime
 
-    for i, feat in enumerate(features):
-        props = feat.get("properties", {})
-        cell_id = props.get(KEY_NAME)
-        if cell_id is None:
-            missing_id += 1
-            cell_id = i  # fallback if missing
-        folder_name = f"cell_{cell_id}"
-        folder_path = OUTPUT_ROOT / folder_name
-        folder_path.mkdir(exist_ok=True)
-        created += 1
+    def collect(futures):
+        nonlocal created, skipped
+        for fut in futures:
+            before = created
+            n_created, n_skipped = fut.result()
+            created += n_created
+            skipped += n_skipped
+            if created // 1000 > before // 1000:
+                print(f"[PROGRESS] {created} folders created...")
 
-        # Optional: write this feature's geometry into its folder as GeoJSON
-        single_feat = {
-            "type": "FeatureCollection",
-            "features": [feat]
-        }
-        single_path = folder_path / f"{folder_name}.geojson"
-        single_path.write_text(json.dumps(single_feat))
-        
-        if created % 1000 == 0:
-            print(f"[PROGRESS] {created} folders created...")
+    # Batches are fanned out to worker processes; at most 2 per worker are in flight so
+    # streamed features are not all buffered in memory.
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        pending = set()
+        batch = []
+        for i, feat in enumerate(iter_features(INPUT_FILE)):
+            props = feat.get("properties", {})
+            cell_id = props.get(KEY_NAME)
+            if cell_id is None:
+                missing_id += 1
+                cell_id = i  # fallback if missing
+            batch.append((f"cell_{cell_id}", feat))
+
+            if len(batch) == BATCH_SIZE:
+                pending.add(pool.submit(write_cell_batch, OUTPUT_ROOT, batch, input_mtime))
+                batch = []
+                if len(pending) >= 2 * MAX_WORKERS:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+        if batch:
+            pending.add(pool.submit(write_cell_batch, OUTPUT_ROOT, batch, input_mtime))
+        collect(wait(pending).done)
 
     print(f"[DONE] Created {created} folders in {OUTPUT_ROOT}")
+    if skipped:
+        print(f"[INFO] {skipped} cell GeoJSON files were already up to date and not rewritten.")
     if missing_id:
         print(f"[WARN] {missing_id} features had no '{KEY_NAME}', used index instead.")
 
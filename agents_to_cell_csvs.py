@@ -7,23 +7,43 @@ Inputs:
   --grid     : Grid GeoJSON (either WGS84 or metric UTM). If metric, properties should include utm_crs like 'EPSG:32654'.
   --out-root : Root directory that already contains subfolders named by cell_id (e.g., /.../cell_123/)
   --bucket-id: Constant to attach to each output row (e.g., 0)
+  --points-crs: CRS of the parquet latitude/longitude (y/x) columns (default EPSG:4326)
+  --grid-meta: Optional grid metadata JSON written by make_Grid.py (default: <prefix>_meta.json next to --grid).
+               When it and its cell index/clipped mask/AOI files exist, points are assigned by row/col
+               arithmetic instead of a spatial join; only points in AOI-clipped edge cells get a polygon test.
+  --output-format: csv (default) or parquet.
+  --dedupe-seconds: Keep only the first sample per (agent, cell_id, N-second time bucket); default 60, 0 keeps all.
+  --time-unit: Epoch unit (s, ms, us, ns) of a numeric time column; required to dedupe numeric times.
 
 Output per cell_id:
-  <out-root>/cell_<cell_id>/visits_bucket<bucket_id>.csv
+  csv     : <out-root>/cell_<cell_id>/visits_bucket<bucket_id>.csv
+  parquet : <out-root>/cell_id=<cell_id>/visits_bucket<bucket_id>-<input>-<i>.parquet (hive-partitioned dataset,
+            written in a single pass; cell_id is carried by the partition directory). <input> is a short hash
+            of the --parquet path, so several inputs sharing a bucket id add files instead of replacing them.
 
 Output columns:
   agent, latitude, longitude, timestamp, cell_id, bucket_id
 """
 
 import argparse
+import hashlib
 import json
 import re
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
 from shapely.geometry import Point
-from pyproj import CRS
+from pyproj import CRS, Transformer
+
+from grid_utils import epsg_transformer
+
+try:
+    import numba
+except ImportError:  # fall back to gpd.sjoin when there is no grid index
+    numba = None
 
 def parse_epsg_from_props(gdf: gpd.GeoDataFrame) -> int | None:
     """Extract EPSG from a 'utm_crs' string in properties (e.g., 'EPSG:32654')."""
@@ -36,33 +56,266 @@ def parse_epsg_from_props(gdf: gpd.GeoDataFrame) -> int | None:
     return int(m.group(1)) if m else None
 
 def ensure_grid_crs(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    """Set CRS if missing. If metric geojson with 'utm_crs' in properties, apply that EPSG; else assume WGS84."""
-    if gdf.crs:
-        return gdf
+    """
+    If metric geojson with 'utm_crs' in properties, apply that EPSG; else keep the file CRS or assume WGS84.
+    GeoJSON readers report EPSG:4326 for files without a crs member, so 'utm_crs' takes precedence.
+    """
     epsg = parse_epsg_from_props(gdf)
     if epsg:
-        return gdf.set_crs(CRS.from_epsg(epsg))
+        return gdf.set_crs(CRS.from_epsg(epsg), allow_override=True)
+    if gdf.crs:
+        return gdf
     return gdf.set_crs("EPSG:4326")
 
-def find_time_column(df: pd.DataFrame) -> str:
+def crs_transformer(src: CRS, dst: CRS) -> Transformer | None:
+    """Transformer src -> dst (cached when both have EPSG codes); None when the CRSs already match."""
+    if src == dst:
+        return None
+    src_epsg, dst_epsg = src.to_epsg(), dst.to_epsg()
+    if src_epsg is not None and dst_epsg is not None:
+        return epsg_transformer(src_epsg, dst_epsg)
+    return Transformer.from_crs(src, dst, always_xy=True)
+
+def points_to_crs(x: np.ndarray, y: np.ndarray, src: CRS, dst: CRS) -> tuple[np.ndarray, np.ndarray]:
+    """Project point coordinate arrays from src to dst in one batched call; returned as-is when the CRSs match."""
+    to_dst = crs_transformer(src, dst)
+    if to_dst is None:
+        return x, y
+    xs, ys = to_dst.transform(x, y)
+    return np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+
+def read_grid(path: Path, id_field: str) -> gpd.GeoDataFrame:
+    """
+    Read only the id (and 'utm_crs', used by ensure_grid_crs) columns plus geometry, through pyogrio's
+    Arrow reader; without pyarrow the same columns are read by pyogrio's default reader, and without
+    pyogrio the whole file is read by geopandas' default engine.
+    """
+    columns = [id_field, "utm_crs"]
+    try:
+        return gpd.read_file(path, engine="pyogrio", use_arrow=True, columns=columns)
+    except ImportError:
+        return gpd.read_file(path)
+    except RuntimeError:  # pyogrio raises RuntimeError (not ImportError) when pyarrow is missing
+        return gpd.read_file(path, engine="pyogrio", columns=columns)
+
+def find_time_column(columns) -> str:
     """Pick the best time column name given common variants."""
     for cand in ("timestamp", "time", "datetime", "date_time", "ts"):
-        if cand in df.columns:
+        if cand in columns:
             return cand
     raise ValueError("No time-like column found. Expected one of: timestamp, time, datetime, date_time, ts")
 
-def read_parquet_any(path: Path) -> pd.DataFrame:
-    """Read parquet using whichever engine is available (pyarrow or fastparquet)."""
+def parquet_columns(path: Path) -> list[str]:
+    """List parquet column names from the file footer without reading any data."""
     try:
-        return pd.read_parquet(path, engine="pyarrow")
+        import pyarrow.dataset as ds
+        return ds.dataset(path, format="parquet").schema.names
     except Exception:
         try:
-            return pd.read_parquet(path, engine="fastparquet")
+            from fastparquet import ParquetFile
+            return list(ParquetFile(path).columns)
         except Exception as e:
             raise RuntimeError(
-                f"Failed to read parquet {path}. Install pyarrow or fastparquet. Original error: {e}"
+                f"Failed to read parquet schema {path}. Install pyarrow or fastparquet. Original error: {e}"
             )
 
+def read_parquet_any(path: Path, columns: list[str] | None = None, filters: list | None = None) -> pd.DataFrame:
+    """
+    Read parquet using whichever engine is available (pyarrow or fastparquet).
+    Only `columns` are decoded; pyarrow `filters` skip row groups (and rows) outside them.
+    """
+    try:
+        return pd.read_parquet(path, engine="pyarrow", columns=columns, filters=filters)
+    except Exception:
+        pass
+    try:
+        if filters is not None:
+            return pd.read_parquet(path, engine="pyarrow", columns=columns)
+    except Exception:
+        pass
+    try:
+        return pd.read_parquet(path, engine="fastparquet", columns=columns)
+    except Exception as e:
+        raise RuntimeError(
+            f"Failed to read parquet {path}. Install pyarrow or fastparquet. Original error: {e}"
+        )
+
+def bounds_to_crs(bounds, src: CRS, dst: CRS) -> tuple[float, float, float, float]:
+    """Transform (minx, miny, maxx, maxy) from src to dst, densifying the edges."""
+    to_dst = crs_transformer(src, dst)
+    if to_dst is None:
+        return tuple(bounds)
+    return to_dst.transform_bounds(*bounds, densify_pts=21)
+
+TIME_UNITS_PER_SECOND = {"s": 1, "ms": 1_000, "us": 1_000_000, "ns": 1_000_000_000}
+
+def time_bucket(times: pd.Series, seconds: int, unit: str | None = None) -> np.ndarray:
+    """Integer time bucket of width `seconds`; numeric times are epoch values in `unit` (required for them)."""
+    if pd.api.types.is_numeric_dtype(times):
+        if unit is None:
+            raise ValueError("Numeric time column needs its epoch unit (s, ms, us or ns)")
+        return np.floor_divide(times.to_numpy(), seconds * TIME_UNITS_PER_SECOND[unit])
+    ns = pd.to_datetime(times).to_numpy(dtype="datetime64[ns]").astype(np.int64)
+    return ns // (seconds * 1_000_000_000)
+
+def write_parquet_dataset(df: pd.DataFrame, out_root: Path, basename: str) -> None:
+    """
+    Write df as a hive-partitioned (cell_id=<id>/) parquet dataset in one pass. Files are named
+    <basename>-<i>.parquet, so basename should identify the input: only a rerun of the same input replaces them.
+    Rows should be sorted by cell_id so each partition is written contiguously.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    table = pa.Table.from_pandas(df.assign(cell_id=df["cell_id"].astype("int64")), preserve_index=False)
+    ds.write_dataset(
+        table,
+        base_dir=str(out_root),
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema([("cell_id", pa.int64())]), flavor="hive"),
+        basename_template=f"{basename}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        max_partitions=max(1024, df["cell_id"].nunique()),
+        max_rows_per_file=1_000_000,
+        max_rows_per_group=1_000_000,
+    )
+
+def input_token(path: Path) -> str:
+    """Short stable id for an input file (hash of its resolved path); hive inputs often share a file name."""
+    return hashlib.sha1(str(path.resolve()).encode()).hexdigest()[:10]
+
+def default_grid_meta_path(grid_path: Path) -> Path:
+    """Guess make_Grid.py's metadata path from a grid GeoJSON path (Grid_wgs84.geojson -> Grid_meta.json)."""
+    prefix = re.sub(r"_(wgs84|metric)$", "", grid_path.stem)
+    return grid_path.with_name(f"{prefix}_meta.json")
+
+def load_grid_index(meta_path: Path) -> tuple[dict, np.ndarray, np.ndarray, object] | None:
+    """
+    Load grid metadata, its (rows, cols) cell_id array, the clipped-cell mask and the metric AOI;
+    None if any file is missing. The arrays are memory-mapped, so only the pages touched by the lookup are read.
+    """
+    if not meta_path.exists():
+        return None
+    meta = json.loads(meta_path.read_text())
+    index_name = meta.get("cell_index") or meta_path.name.replace("_meta.json", "_cell_index.npy")
+    index_path = meta_path.with_name(index_name)
+    if not index_path.exists():
+        return None
+    if not meta.get("clipped") or not meta.get("aoi_wkb"):
+        print(f"[WARN] {meta_path} has no clipped-cell mask/AOI (re-run make_Grid.py); using the grid GeoJSON.")
+        return None
+    clipped_path, aoi_path = meta_path.with_name(meta["clipped"]), meta_path.with_name(meta["aoi_wkb"])
+    if not clipped_path.exists() or not aoi_path.exists():
+        return None
+    cell_index = np.load(index_path, mmap_mode="r")
+    clipped = np.load(clipped_path, mmap_mode="r")
+    for arr in (cell_index, clipped):
+        if arr.shape != (meta["rows"], meta["cols"]):
+            raise ValueError(f"Grid array shape {arr.shape} does not match metadata "
+                             f"({meta['rows']}, {meta['cols']}) in {meta_path}")
+    aoi_m = shapely.from_wkb(aoi_path.read_bytes())
+    shapely.prepare(aoi_m)
+    return meta, cell_index, clipped, aoi_m
+
+def assign_cells_from_index(x: np.ndarray, y: np.ndarray, meta: dict, cell_index: np.ndarray,
+                            clipped: np.ndarray, aoi_m, points_crs: CRS) -> np.ndarray:
+    """
+    Map points (in points_crs) to cell ids via floor((x - start_x) / cell); -1 for points outside the grid/AOI.
+    Only points landing in AOI-clipped edge cells are tested against the AOI polygon.
+    """
+    xs, ys = points_to_crs(x, y, points_crs, CRS.from_epsg(meta["utm_epsg"]))
+    cell = meta["cell_size"]
+    ok = np.isfinite(xs) & np.isfinite(ys)
+    c = np.full(len(xs), -1, dtype=np.int32)
+    r = np.full(len(ys), -1, dtype=np.int32)
+    c[ok] = np.floor((xs[ok] - meta["start_x"]) / cell).astype(np.int32)
+    r[ok] = np.floor((ys[ok] - meta["start_y"]) / cell).astype(np.int32)
+    inside = ok & (c >= 0) & (c < meta["cols"]) & (r >= 0) & (r < meta["rows"])
+
+    cell_ids = np.full(len(xs), -1, dtype=cell_index.dtype)
+    cell_ids[inside] = cell_index[r[inside], c[inside]]
+
+    hit = np.flatnonzero(cell_ids >= 0)
+    edge = hit[clipped[r[hit], c[hit]]]
+    if len(edge):
+        cell_ids[edge[~shapely.contains_xy(aoi_m, xs[edge], ys[edge])]] = -1
+    return cell_ids
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _bucket_cells(bbox, x0, y0, size, nbx, nby):
+        """CSR lists of cell positions per bucket of a uniform size x size index over the grid extent."""
+        n = bbox.shape[0]
+        counts = np.zeros(nbx * nby + 1, np.int64)
+        for k in range(n):
+            bx0, bx1 = int((bbox[k, 0] - x0) // size), min(int((bbox[k, 2] - x0) // size), nbx - 1)
+            by0, by1 = int((bbox[k, 1] - y0) // size), min(int((bbox[k, 3] - y0) // size), nby - 1)
+            for by in range(by0, by1 + 1):
+                for bx in range(bx0, bx1 + 1):
+                    counts[by * nbx + bx + 1] += 1
+        offsets = np.cumsum(counts)
+        cells = np.empty(offsets[-1], np.int64)
+        fill = offsets[:-1].copy()
+        for k in range(n):
+            bx0, bx1 = int((bbox[k, 0] - x0) // size), min(int((bbox[k, 2] - x0) // size), nbx - 1)
+            by0, by1 = int((bbox[k, 1] - y0) // size), min(int((bbox[k, 3] - y0) // size), nby - 1)
+            for by in range(by0, by1 + 1):
+                for bx in range(bx0, bx1 + 1):
+                    b = by * nbx + bx
+                    cells[fill[b]] = k
+                    fill[b] += 1
+        return offsets, cells
+
+    @numba.njit(parallel=True, cache=True)
+    def _assign_cells_kernel(px, py, xs, ys, ring_offsets, cell_ring_offsets, bbox,
+                             bucket_offsets, bucket_cells, x0, y0, size, nbx, nby):
+        """Even-odd ray casting over every ring of each candidate cell; returns cell position or -1 per point."""
+        out = np.full(px.shape[0], -1, np.int64)
+        for i in numba.prange(px.shape[0]):
+            x, y = px[i], py[i]
+            if not (x >= x0 and y >= y0):  # also rejects NaN
+                continue
+            bx, by = int((x - x0) // size), int((y - y0) // size)
+            if bx >= nbx or by >= nby:
+                continue
+            b = by * nbx + bx
+            for j in range(bucket_offsets[b], bucket_offsets[b + 1]):
+                k = bucket_cells[j]
+                if x < bbox[k, 0] or x > bbox[k, 2] or y < bbox[k, 1] or y > bbox[k, 3]:
+                    continue
+                inside = False
+                for ring in range(cell_ring_offsets[k], cell_ring_offsets[k + 1]):
+                    for m in range(ring_offsets[ring], ring_offsets[ring + 1] - 1):
+                        xa, ya, xb, yb = xs[m], ys[m], xs[m + 1], ys[m + 1]
+                        if (ya > y) != (yb > y) and x < xa + (y - ya) * (xb - xa) / (yb - ya):
+                            inside = not inside
+                if inside:
+                    out[i] = k
+                    break
+        return out
+
+def assign_cells_numba(px: np.ndarray, py: np.ndarray, geoms: np.ndarray) -> np.ndarray:
+    """
+    Point-in-polygon for arbitrary (multi)polygon cells with the numba kernels; returns the position of the
+    containing cell in `geoms` or -1. Points must already be in the geometries' CRS.
+    """
+    parts, part_cell = shapely.get_parts(geoms, return_index=True)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    ring_cell = part_cell[ring_part]
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+    ring_offsets = np.searchsorted(coord_ring, np.arange(len(rings) + 1))
+    cell_ring_offsets = np.searchsorted(ring_cell, np.arange(len(geoms) + 1))
+    bbox = shapely.bounds(geoms)
+
+    x0, y0 = np.nanmin(bbox[:, 0]), np.nanmin(bbox[:, 1])
+    size = float(np.nanmedian(np.maximum(bbox[:, 2] - bbox[:, 0], bbox[:, 3] - bbox[:, 1]))) or 1.0
+    nbx = int((np.nanmax(bbox[:, 2]) - x0) // size) + 1
+    nby = int((np.nanmax(bbox[:, 3]) - y0) // size) + 1
+    bucket_offsets, bucket_cells = _bucket_cells(bbox, x0, y0, size, nbx, nby)
+
+    return _assign_cells_kernel(px, py, coords[:, 0].copy(), coords[:, 1].copy(), ring_offsets, cell_ring_offsets,
+                                bbox, bucket_offsets, bucket_cells, x0, y0, size, nbx, nby)
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--parquet", required=True, type=Path,
@@ -75,49 +328,113 @@ def main():
     ap.add_argument("--grid-id-field", default="cell_id", help="Grid id field name (default 'cell_id').")
     # Match your parquet schema defaults:
     ap.add_argument("--agent-id-field", default="agent", help="Agent id field name (default 'agent').")
-    ap.add_argument("--latitude-field", default="latitude", help="Latitude field name (default 'latitude').")
-    ap.add_argument("--longitude-field", default="longitude", help="Longitude field name (default 'longitude').")
+    ap.add_argument("--latitude-field", default="latitude", help="Latitude (y) field name (default 'latitude').")
+    ap.add_argument("--longitude-field", default="longitude", help="Longitude (x) field name (default 'longitude').")
+    ap.add_argument("--points-crs", default="EPSG:4326",
+                    help="CRS of the parquet x/y columns (default EPSG:4326). No reprojection if it matches the grid.")
     ap.add_argument("--output-filename", default=None,
                     help="CSV filename inside each cell folder. Default: visits_bucket<B>.csv")
+    ap.add_argument("--output-format", choices=("csv", "parquet"), default="csv",
+                    help="csv: append to one CSV per cell folder (default). "
+                         "parquet: single-pass hive-partitioned dataset under --out-root.")
+    ap.add_argument("--dedupe-seconds", type=int, default=60,
+                    help="Keep the first sample per (agent, cell, N-second bucket) (default 60; 0 keeps every sample).")
+    ap.add_argument("--time-unit", choices=tuple(TIME_UNITS_PER_SECOND), default=None,
+                    help="Epoch unit of a numeric time column; required for deduping numeric times.")
+    ap.add_argument("--grid-meta", type=Path, default=None,
+                    help="Grid metadata JSON from make_Grid.py. Default: <prefix>_meta.json next to --grid.")
     args = ap.parse_args()
+    points_crs = CRS.from_user_input(args.points_crs)
+
+    # --- Load grid: row/col index if make_Grid.py metadata is available, else full GeoJSON ---
+    grid_index = None
+    if args.grid_id_field == "cell_id":
+        meta_path = args.grid_meta or default_grid_meta_path(args.grid)
+        grid_index = load_grid_index(meta_path)
+        if grid_index is not None:
+            print(f"[INFO] Using grid index: {meta_path}")
+        elif args.grid_meta is not None:
+            raise FileNotFoundError(f"Grid metadata, cell index or clipped mask not found for {args.grid_meta}")
 
-    # --- Load grid ---
-    print(f"[INFO] Reading grid: {args.grid}")
-    grid = gpd.read_file(args.grid)
-    grid = ensure_grid_crs(grid)
+    bbox_pts = None  # grid extent in points_crs, for parquet pruning
+    if grid_index is not None:
+        meta = grid_index[0]
+        bbox_pts = bounds_to_crs((meta["start_x"], meta["start_y"],
+                                  meta["start_x"] + meta["cols"] * meta["cell_size"],
+                                  meta["start_y"] + meta["rows"] * meta["cell_size"]),
+                                 CRS.from_epsg(meta["utm_epsg"]), points_crs)
+    else:
+        print(f"[INFO] Reading grid: {args.grid}")
+        grid = read_grid(args.grid, args.grid_id_field)
+        grid = ensure_grid_crs(grid)
 
-    if args.grid_id_field not in grid.columns:
-        raise KeyError(f"Grid id field '{args.grid_id_field}' not found in grid attributes. Columns: {list(grid.columns)}")
+        if args.grid_id_field not in grid.columns:
+            raise KeyError(f"Grid id field '{args.grid_id_field}' not found in grid attributes. Columns: {list(grid.columns)}")
 
-    # Keep only id + geometry to lighten the sjoin
-    grid = grid[[args.grid_id_field, "geometry"]].copy()
+        # Keep only id + geometry to lighten the join (drops utm_crs once the CRS is set)
+        grid = grid[[args.grid_id_field, "geometry"]]
+        bbox_pts = bounds_to_crs(grid.total_bounds, grid.crs, points_crs)
 
-    # --- Load agents parquet ---
+    # --- Load agents parquet (only the needed columns, row groups outside the grid bbox skipped) ---
     print(f"[INFO] Reading trajectories parquet: {args.parquet}")
-    df = read_parquet_any(args.parquet)
+    columns = parquet_columns(args.parquet)
 
     # Validate columns
     for col in (args.agent_id_field, args.latitude_field, args.longitude_field):
-        if col not in df.columns:
-            raise KeyError(f"Expected column '{col}' in parquet. Found columns: {list(df.columns)}")
-    time_col = find_time_column(df)
-
-    # --- Build points GeoDataFrame in WGS84 then reproject to grid CRS if needed ---
-    print("[INFO] Building point GeoDataFrame...")
-    pts = gpd.GeoDataFrame(
-        df[[args.agent_id_field, time_col, args.latitude_field, args.longitude_field]].copy(),
-        geometry=gpd.points_from_xy(df[args.longitude_field], df[args.latitude_field]),
-        crs="EPSG:4326"
+        if col not in columns:
+            raise KeyError(f"Expected column '{col}' in parquet. Found columns: {list(columns)}")
+    time_col = find_time_column(columns)
+
+    filters = None
+    if bbox_pts is not None:
+        minx, miny, maxx, maxy = bbox_pts
+        filters = [(args.longitude_field, ">=", minx), (args.longitude_field, "<=", maxx),
+                   (args.latitude_field, ">=", miny), (args.latitude_field, "<=", maxy)]
+    df = read_parquet_any(
+        args.parquet,
+        columns=[args.agent_id_field, time_col, args.latitude_field, args.longitude_field],
+        filters=filters,
     )
-    if grid.crs is None:
-        grid = grid.set_crs("EPSG:4326")
-    if pts.crs != grid.crs:
-        print(f"[INFO] Reprojecting points to grid CRS: {grid.crs.to_string() if grid.crs else grid.crs}")
-        pts = pts.to_crs(grid.crs)
+    if args.dedupe_seconds > 0 and args.time_unit is None and pd.api.types.is_numeric_dtype(df[time_col]):
+        raise ValueError(f"Time column '{time_col}' is numeric; pass --time-unit (s, ms, us or ns) "
+                         f"or --dedupe-seconds 0 to keep every sample.")
+
+    if grid_index is not None:
+        # --- Direct lookup: project to UTM once, then floor to row/col ---
+        print("[INFO] Assigning points to cells by row/col lookup...")
+        meta, cell_index, clipped, aoi_m = grid_index
+        cell_ids = assign_cells_from_index(
+            df[args.longitude_field].to_numpy(dtype=float),
+            df[args.latitude_field].to_numpy(dtype=float),
+            meta, cell_index, clipped, aoi_m, points_crs,
+        )
+        keep = cell_ids >= 0
+        joined = df.loc[keep, [args.agent_id_field, time_col, args.latitude_field, args.longitude_field]].assign(
+            **{args.grid_id_field: cell_ids[keep]}
+        )
+    else:
+        # --- Project raw x/y arrays straight to the grid CRS (no GeoDataFrame + to_crs pass) ---
+        xs = df[args.longitude_field].to_numpy(dtype=float)
+        ys = df[args.latitude_field].to_numpy(dtype=float)
+        if points_crs == grid.crs:
+            print(f"[INFO] Points already in grid CRS {grid.crs.to_string()}; skipping reprojection")
+        else:
+            print(f"[INFO] Projecting points to grid CRS: {grid.crs.to_string()}")
+            xs, ys = points_to_crs(xs, ys, points_crs, grid.crs)
 
-    # --- Spatial join: point within polygon (cell) ---
-    print("[INFO] Spatial join (points → cells)...")
-    joined = gpd.sjoin(pts, grid, predicate="within", how="inner")
+        if numba is not None:
+            # --- No grid index: numba point-in-polygon over the grid's rings ---
+            print("[INFO] Assigning points to cells with numba point-in-polygon...")
+            pos = assign_cells_numba(xs, ys, grid.geometry.values)
+            keep = pos >= 0
+            joined = df.loc[keep, [args.agent_id_field, time_col, args.latitude_field, args.longitude_field]].assign(
+                **{args.grid_id_field: grid[args.grid_id_field].to_numpy()[pos[keep]]}
+            )
+        else:
+            # --- Spatial join: point within polygon (cell) ---
+            pts = gpd.GeoDataFrame(df, geometry=shapely.points(xs, ys), crs=grid.crs)
+            print("[INFO] Spatial join (points → cells)...")
+            joined = gpd.sjoin(pts, grid, predicate="within", how="inner")
 
     if joined.empty:
         print("[WARN] No points fell inside any grid cells. Nothing to write.")
@@ -127,25 +444,41 @@ def main():
     joined["cell_id"] = joined[args.grid_id_field]
     joined["bucket_id"] = args.bucket_id
 
+    # --- Collapse repeated samples of an agent within the same cell and time bucket to the first one ---
+    if args.dedupe_seconds > 0:
+        n_before = len(joined)
+        joined = joined.sort_values(time_col, kind="stable")
+        tb = time_bucket(joined[time_col], args.dedupe_seconds, args.time_unit)
+        joined = joined[~joined.assign(_tb=tb).duplicated([args.agent_id_field, "cell_id", "_tb"])]
+        print(f"[INFO] Deduped to first sample per {args.dedupe_seconds}s bucket: {n_before} -> {len(joined)} rows")
+
     # --- Prepare output columns in the requested order ---
     out_cols = [args.agent_id_field, args.latitude_field, args.longitude_field, time_col, "cell_id", "bucket_id"]
 
+    if args.output_format == "parquet":
+        basename = Path(args.output_filename).stem if args.output_filename else f"visits_bucket{args.bucket_id}"
+        basename = f"{basename}-{input_token(args.parquet)}"
+        print(f"[INFO] Writing parquet dataset to: {args.out_root}/cell_id=<id>/{basename}-<i>.parquet")
+        args.out_root.mkdir(parents=True, exist_ok=True)
+        write_parquet_dataset(joined[out_cols].sort_values(["cell_id", time_col]), args.out_root, basename)
+        print(f"[DONE] Wrote {len(joined)} rows across {joined['cell_id'].nunique()} cell partitions.")
+        return
+
     # --- Write CSV per cell folder ---
     out_name = args.output_filename or f"visits_bucket{args.bucket_id}.csv"
     print(f"[INFO] Writing per-cell CSVs to: {args.out_root}/cell_<id>/{out_name}")
     args.out_root.mkdir(parents=True, exist_ok=True)
 
+    # Sort once up front so each group is already time-ordered and needs no per-cell copy/sort
+    out_all = joined[out_cols].sort_values(["cell_id", time_col], kind="stable")
+
     count_cells = 0
     count_rows = 0
-    for cell_id, sub in joined.groupby("cell_id", sort=True):
+    for cell_id, out_df in out_all.groupby("cell_id", sort=False):
         folder = args.out_root / f"cell_{cell_id}"
         folder.mkdir(parents=True, exist_ok=True)
         out_csv = folder / out_name
 
-        out_df = sub[out_cols].copy()
-        # Sort by time (optional)
-        out_df = out_df.sort_values(by=time_col)
-
         write_header = not out_csv.exists()
         out_df.to_csv(out_csv, mode="a", header=write_header, index=False)
 
@@ -7,9 +7,15 @@ Usage:
 """
 
 import argparse
+import os
 from pathlib import Path
 import csv
 
+def dir_has_file(path: str, name: str) -> bool:
+    """Check for a file by name from one directory listing (no per-file stat)."""
+    with os.scandir(path) as it:
+        return any(e.name == name for e in it)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--root", required=True, type=Path, help="Root folder containing cell_<id> subfolders.")
@@ -27,19 +33,25 @@ def main():
     missing = []
 
     print(f"[INFO] Scanning {root} for '{pattern}' ...")
-    for cell_dir in sorted(root.glob("cell_*")):
-        if not cell_dir.is_dir():
-            continue
-        csv_path = cell_dir / pattern
-        if csv_path.exists():
-            # extract numeric ID (e.g., "cell_12345" → 12345)
-            try:
-                cell_id = int(cell_dir.name.replace("cell_", ""))
-            except ValueError:
-                cell_id = cell_dir.name
-            found.append(cell_id)
-        else:
-            missing.append(cell_dir.name)
+    # One scandir pass: is_dir() uses the cached d_type, and sorting happens once on the results
+    with os.scandir(root) as entries:
+        for entry in entries:
+            name = entry.name
+            if not name.startswith("cell_") or not entry.is_dir():
+                continue
+            if dir_has_file(entry.path, pattern):
+                found.append(name)
+            else:
+                missing.append(name)
+    found.sort()
+    missing.sort()
+
+    # extract numeric ID (e.g., "cell_12345" → 12345)
+    for i, name in enumerate(found):
+        try:
+            found[i] = int(name.replace("cell_", ""))
+        except ValueError:
+            pass
 
     print(f"[INFO] Found {len(found)} folders containing {pattern}.")
     if missing:
@@ -0,0 +1,27 @@
+"""
+Small helpers shared by the grid scripts (import from the same directory).
+"""
+
+import json
+from functools import lru_cache
+from pyproj import CRS, Transformer
+
+try:
+    import orjson
+except ImportError:  # stdlib fallback, slower
+    orjson = None
+
+
+@lru_cache(maxsize=16)
+def epsg_transformer(src: int, dst: int, always_xy: bool = True) -> Transformer | None:
+    """EPSG->EPSG Transformer, built once per process for each pair; None if src == dst."""
+    if src == dst:
+        return None
+    return Transformer.from_crs(CRS.from_epsg(src), CRS.from_epsg(dst), always_xy=always_xy)
+
+
+def jdumps(obj) -> bytes:
+    """Serialize to JSON bytes with orjson when installed (numpy arrays/scalars allowed), else stdlib json."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, default=lambda o: o.tolist()).encode()
@@ -4,12 +4,17 @@ Create a 50 m x 50 m grid over an AOI and CLIP edge cells for full coverage.
 Includes detailed print statements for progress monitoring.
 """
 
-import json, math, time
+import json, math, os, time
+from collections import deque
+from multiprocessing import Pool
 from pathlib import Path
-from shapely.geometry import shape, mapping, Polygon, MultiPolygon, box
+import numpy as np
+import shapely
+from shapely.geometry import shape, mapping, Polygon, MultiPolygon
 from shapely.ops import unary_union
-from shapely.prepared import prep
-from pyproj import CRS, Transformer
+from pyproj import CRS
+
+from grid_utils import epsg_transformer, jdumps
 
 
 def load_aoi(path: Path):
@@ -47,18 +52,107 @@ def project_poly(geom, transformer):
         raise TypeError("AOI must be Polygon or MultiPolygon")
 
 
-def to_wgs_geom(geom, transformer):
-    if isinstance(geom, Polygon):
-        ext_x, ext_y = transformer.transform(*zip(*geom.exterior.coords))
-        interiors = []
-        for ring in geom.interiors:
-            ix, iy = transformer.transform(*zip(*ring.coords))
-            interiors.append(list(zip(ix, iy)))
-        return Polygon(list(zip(ext_x, ext_y)), interiors)
-    elif isinstance(geom, MultiPolygon):
-        return MultiPolygon([to_wgs_geom(p, transformer) for p in geom.geoms])
+def to_wgs_geoms(geoms, transformer):
+    """Reproject an array of geometries with a single batched transform over all their coordinates."""
+    coords = shapely.get_coordinates(geoms)
+    xs, ys = transformer.transform(coords[:, 0], coords[:, 1])
+    return shapely.set_coordinates(geoms.copy(), np.column_stack([xs, ys]))
+
+
+def clip_band(r_start, r_stop, x_edges, y_edges, aoi_m, aoi_parts=None, aoi_tree=None):
+    """
+    Clip grid rows [r_start, r_stop) against the AOI in one batch.
+    Returns kept rows, cols, geometries and a mask of cells lying wholly inside the AOI; those are
+    kept as their square (no intersection needed), the rest are clipped.
+    For a multipart AOI pass its prepared parts and an STRtree over them to find touching cells in one query.
+    """
+    cols = len(x_edges) - 1
+    x0, y0 = (a.ravel() for a in np.meshgrid(x_edges[:-1], y_edges[r_start:r_stop]))
+    x1, y1 = (a.ravel() for a in np.meshgrid(x_edges[1:], y_edges[r_start + 1:r_stop + 1]))
+    cells = shapely.box(x0, y0, x1, y1)
+
+    if aoi_tree is None:
+        hit = np.flatnonzero(shapely.intersects(cells, aoi_m))
     else:
-        raise TypeError("Expected Polygon or MultiPolygon")
+        cand_cells, cand_parts = aoi_tree.query(cells)  # envelope candidates only
+        touching = shapely.intersects(aoi_parts[cand_parts], cells[cand_cells])
+        hit = np.unique(cand_cells[touching])
+
+    geoms = cells[hit]
+    full = shapely.contains(aoi_m, geoms)
+    if not full.all():
+        geoms[~full] = shapely.intersection(geoms[~full], aoi_m)
+    # Unclipped squares, clockwise from lower-left as GEOS overlay would have returned them
+    k = hit[full]
+    geoms[full] = shapely.box(x0[k], y0[k], x1[k], y1[k], ccw=False)
+    nonempty = ~shapely.is_empty(geoms)
+    hit, geoms, full = hit[nonempty], geoms[nonempty], full[nonempty]
+    r, c = np.divmod(hit, cols)
+    return r + r_start, c, geoms, full
+
+
+def band_to_wgs(r_start, r_stop, band_rows, band_cols, geoms, full, x_edges, y_edges, transformer):
+    """
+    Reproject a band's cells. Unclipped squares are assembled from one transform of the band's shared
+    corner grid (one point per cell instead of five); only clipped edge cells go through to_wgs_geoms.
+    """
+    wgs = np.empty(len(geoms), dtype=object)
+    if not full.all():
+        wgs[~full] = to_wgs_geoms(geoms[~full], transformer)
+    if full.any():
+        gx, gy = np.meshgrid(x_edges, y_edges[r_start:r_stop + 1])
+        lon, lat = transformer.transform(gx.ravel(), gy.ravel())
+        lon, lat = lon.reshape(gx.shape), lat.reshape(gx.shape)
+        r, c = band_rows[full] - r_start, band_cols[full]
+        # Same vertex order as the metric squares: (x0,y0) (x0,y1) (x1,y1) (x1,y0) (x0,y0)
+        ri = np.stack([r, r + 1, r + 1, r, r], axis=1)
+        ci = np.stack([c, c, c + 1, c + 1, c], axis=1)
+        wgs[full] = shapely.polygons(np.stack([lon[ri, ci], lat[ri, ci]], axis=-1))
+    return wgs
+
+
+_band_ctx = {}
+
+
+def _init_band_worker(aoi_wkb, x_edges, y_edges, utm_epsg):
+    """Pool initializer: rebuild the AOI from WKB once per worker and prepare/index it locally."""
+    aoi_m = shapely.from_wkb(aoi_wkb)
+    shapely.prepare(aoi_m)
+    aoi_parts = aoi_tree = None
+    if isinstance(aoi_m, MultiPolygon):
+        aoi_parts = np.array(aoi_m.geoms)
+        shapely.prepare(aoi_parts)
+        aoi_tree = shapely.STRtree(aoi_parts)
+    _band_ctx.update(aoi_m=aoi_m, aoi_parts=aoi_parts, aoi_tree=aoi_tree,
+                     x_edges=x_edges, y_edges=y_edges, to_wgs=epsg_transformer(utm_epsg, 4326))
+
+
+def _process_band(band):
+    """Worker: clip and reproject one band of rows; returns kept rows/cols/unclipped mask/areas and serialized geometries."""
+    r_start, r_stop = band
+    ctx = _band_ctx
+    rows, cols, geoms, full = clip_band(r_start, r_stop, ctx["x_edges"], ctx["y_edges"], ctx["aoi_m"],
+                                        ctx["aoi_parts"], ctx["aoi_tree"])
+    areas = shapely.area(geoms)
+    geoms_wgs = band_to_wgs(r_start, r_stop, rows, cols, geoms, full, ctx["x_edges"], ctx["y_edges"], ctx["to_wgs"])
+    return (r_start, rows, cols, full, areas.tolist(),
+            [jdumps(mapping(g)) for g in geoms], [jdumps(mapping(g)) for g in geoms_wgs])
+
+
+def imap_bounded(pool, func, items, window):
+    """Like pool.imap (results in order), but with at most `window` tasks submitted and not yet consumed."""
+    pending = deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def feature_bytes(props, geometry_json: bytes) -> bytes:
+    """Assemble a GeoJSON Feature around an already-serialized geometry."""
+    return b'{"type":"Feature","properties":' + jdumps(props) + b',"geometry":' + geometry_json + b'}'
 
 
 def main():
@@ -70,12 +164,13 @@ def main():
     aoi_wgs = load_aoi(AOI_PATH)
     cent = aoi_wgs.centroid
     utm = best_utm(cent.x, cent.y)
-    to_utm = Transformer.from_crs(4326, utm, always_xy=True)
-    to_wgs = Transformer.from_crs(utm, 4326, always_xy=True)
+    utm_epsg, utm_str = utm.to_epsg(), utm.to_string()
+    to_utm = epsg_transformer(4326, utm_epsg)
 
     print("[INFO] Projecting AOI to UTM coordinates...")
     aoi_m = project_poly(aoi_wgs, to_utm)
-    aoi_prep = prep(aoi_m)
+    if isinstance(aoi_m, MultiPolygon):
+        print(f"[INFO] AOI has {len(aoi_m.geoms)} parts; workers index them in an STRtree.")
     print("[INFO] AOI projection complete.")
 
     minx, miny, maxx, maxy = aoi_m.bounds
@@ -84,49 +179,71 @@ def main():
     cols = int(math.ceil((maxx - start_x) / CELL))
     rows = int(math.ceil((maxy - start_y) / CELL))
     print(f"[INFO] Grid bounds: {cols} cols x {rows} rows (approx {cols*rows} cells)")
+    x_edges = start_x + np.arange(cols + 1) * CELL
+    y_edges = start_y + np.arange(rows + 1) * CELL
 
-    features_metric, features_wgs84 = [], []
+    out_metric = Path(f"{OUT_PREFIX}_metric.geojson")
+    out_wgs84 = Path(f"{OUT_PREFIX}_wgs84.geojson")
+    cell_index = np.full((rows, cols), -1, dtype=np.int32)
+    clipped = np.zeros((rows, cols), dtype=bool)
     cell_id = 0
     checkpoint = max(1, rows // 20)  # print every 5% of rows
-
-    for r in range(rows):
-        if r % checkpoint == 0:
-            print(f"[PROGRESS] Processing row {r+1}/{rows} ({(r/rows)*100:.1f}%)")
-        y0 = start_y + r * CELL
-        for c in range(cols):
-            x0 = start_x + c * CELL
-            cell = box(x0, y0, x0 + CELL, y0 + CELL)
-            if not aoi_prep.intersects(cell):
-                continue
-            inter = cell.intersection(aoi_m)
-            if inter.is_empty:
-                continue
-
-            features_metric.append({
-                "type": "Feature",
-                "properties": {"cell_id": cell_id, "row": r, "col": c,
-                               "utm_crs": utm.to_string(), "area_m2": float(inter.area)},
-                "geometry": mapping(inter)
-            })
-            inter_w = to_wgs_geom(inter, to_wgs)
-            features_wgs84.append({
-                "type": "Feature",
-                "properties": {"cell_id": cell_id, "row": r, "col": c,
-                               "area_m2": float(inter.area)},
-                "geometry": mapping(inter_w)
-            })
-            cell_id += 1
+    next_report = 0
+    workers = os.cpu_count() or 1
+    # ~4 bands per worker evens out uneven band costs; never more than 5% of rows so each band stays small
+    band_size = max(1, min(checkpoint, math.ceil(rows / (4 * workers))))
+    bands = [(r, min(rows, r + band_size)) for r in range(0, rows, band_size)]
+
+    # Bands are clipped/reprojected in worker processes (AOI shipped once as WKB); results come back in
+    # order so cell ids stay sequential, and are streamed straight to both files. At most 2 bands per
+    # worker are in flight, so finished bands cannot pile up while this process writes.
+    print(f"[INFO] Processing {len(bands)} row bands on {workers} worker(s)")
+    print(f"[INFO] Streaming GeoJSON outputs to {out_metric} and {out_wgs84}")
+    with out_metric.open("wb") as f_metric, out_wgs84.open("wb") as f_wgs84, \
+            Pool(workers, initializer=_init_band_worker,
+                 initargs=(shapely.to_wkb(aoi_m), x_edges, y_edges, utm_epsg)) as pool:
+        f_metric.write(b'{"type": "FeatureCollection", "features": [')
+        f_wgs84.write(b'{"type": "FeatureCollection", "features": [')
+
+        for band_start, band_rows, band_cols, band_full, band_areas, geoms_json, geoms_wgs_json in \
+                imap_bounded(pool, _process_band, bands, 2 * workers):
+            if band_start >= next_report:
+                print(f"[PROGRESS] Processed row {band_start+1}/{rows} ({(band_start/rows)*100:.1f}%)")
+                next_report = band_start + checkpoint
+            for r, c, area, geom_json, geom_wgs_json in zip(band_rows.tolist(), band_cols.tolist(), band_areas,
+                                                            geoms_json, geoms_wgs_json):
+                sep = b"," if cell_id else b""
+                f_metric.write(sep + feature_bytes(
+                    {"cell_id": cell_id, "row": r, "col": c, "utm_crs": utm_str, "area_m2": area}, geom_json))
+                f_wgs84.write(sep + feature_bytes(
+                    {"cell_id": cell_id, "row": r, "col": c, "area_m2": area}, geom_wgs_json))
+                cell_id += 1
+            cell_index[band_rows, band_cols] = np.arange(cell_id - len(band_rows), cell_id)
+            clipped[band_rows, band_cols] = ~band_full
+
+        f_metric.write(b"]}")
+        f_wgs84.write(b"]}")
 
     print(f"[INFO] Clipping complete — {cell_id} total cells inside AOI.")
-    print("[INFO] Writing GeoJSON outputs...")
 
-    out_metric = Path(f"{OUT_PREFIX}_metric.geojson")
-    out_wgs84 = Path(f"{OUT_PREFIX}_wgs84.geojson")
-    out_metric.write_text(json.dumps({"type": "FeatureCollection", "features": features_metric}))
-    out_wgs84.write_text(json.dumps({"type": "FeatureCollection", "features": features_wgs84}))
+    # Grid layout sidecar: lets consumers map points to cells with row/col arithmetic. Points landing in
+    # clipped edge cells still need a point-in-AOI test, so the clipped mask and metric AOI are saved too.
+    out_meta = Path(f"{OUT_PREFIX}_meta.json")
+    out_index = Path(f"{OUT_PREFIX}_cell_index.npy")
+    out_clipped = Path(f"{OUT_PREFIX}_clipped.npy")
+    out_aoi = Path(f"{OUT_PREFIX}_aoi_utm.wkb")
+    out_meta.write_bytes(jdumps({
+        "start_x": start_x, "start_y": start_y, "cell_size": CELL,
+        "rows": rows, "cols": cols, "utm_epsg": utm_epsg, "cell_index": out_index.name,
+        "clipped": out_clipped.name, "aoi_wkb": out_aoi.name,
+    }))
+    np.save(out_index, cell_index)
+    np.save(out_clipped, clipped)
+    out_aoi.write_bytes(shapely.to_wkb(aoi_m))
 
     print(f"[DONE] Metric GeoJSON saved to {out_metric}")
     print(f"[DONE] WGS84 GeoJSON saved to {out_wgs84}")
+    print(f"[DONE] Grid metadata saved to {out_meta}, {out_index}, {out_clipped} and {out_aoi}")
     print(f"[INFO] Total runtime: {(time.time() - t0):.1f} seconds.")
 
 
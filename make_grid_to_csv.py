@@ -15,12 +15,14 @@ Columns:
 import json
 import re
 from pathlib import Path
+import numpy as np
+import pandas as pd
+import shapely
 from shapely.geometry import shape
-from shapely.geometry.base import BaseGeometry
-from pyproj import CRS, Transformer
-import csv
 import sys
 
+from grid_utils import epsg_transformer
+
 IN_PATH = Path("/datassd4_8tb/p2t4_common_data/datassd4_8tb/p2t4_common_data/Grid_folder/cell_229735/cell_229735.geojson")
 OUT_PATH = Path("/datassd4_8tb/p2t4_common_data/pushpita/GridApplication/cell_229735.csv")
 
@@ -43,9 +45,17 @@ def get_utm_from_features(features):
             return epsg
     return None
 
-def centroid_xy(geom: BaseGeometry) -> tuple[float, float]:
-    c = geom.centroid
-    return float(c.x), float(c.y)
+def centroids_xy(geoms: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Centroid x/y for an array of geometries in one batched GEOS call (NaN for empty geometries)."""
+    cents = shapely.centroid(geoms)
+    return shapely.get_x(cents), shapely.get_y(cents)
+
+def int_column(values: list) -> pd.Series:
+    """Nullable Int64 column (None -> blank) when values are all ints, else object dtype as-is."""
+    try:
+        return pd.Series(pd.array(values, dtype="Int64"))
+    except (TypeError, ValueError):
+        return pd.Series(values, dtype=object)
 
 def main():
     if not IN_PATH.exists():
@@ -63,51 +73,60 @@ def main():
     to_wgs = None
     if utm_epsg:
         try:
-            to_wgs = Transformer.from_crs(CRS.from_epsg(utm_epsg), CRS.from_epsg(4326), always_xy=True)
+            to_wgs = epsg_transformer(utm_epsg, 4326)
         except Exception as e:
             print(f"WARNING: could not build transformer from EPSG:{utm_epsg} -> 4326: {e}", file=sys.stderr)
             to_wgs = None
     else:
         print("WARNING: 'utm_crs' not found or unparsable in properties; lon/lat will be blank.", file=sys.stderr)
 
-    rows_written = 0
-    with OUT_PATH.open("w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        w.writerow(["cell_id", "row", "col", "area_m2", "centroid_x_m", "centroid_y_m", "lon", "lat"])
-
-        for i, feat in enumerate(features):
-            props = feat.get("properties", {}) or {}
-            geom = shape(feat.get("geometry", {}))
-
-            # core fields (tolerate missing props)
-            cell_id = props.get("cell_id", i)
-            row_idx = props.get("row", None)
-            col_idx = props.get("col", None)
-
-            # area: use stored value if present, else compute
-            area_m2 = props.get("area_m2", None)
-            if area_m2 is None:
-                try:
-                    area_m2 = float(geom.area)
-                except Exception:
-                    area_m2 = ""
-
-            # centroids in metric coords
+    # Batched geometry work: one centroid call and one transform call for all features
+    geoms = np.array([shape(feat.get("geometry", {})) for feat in features], dtype=object)
+    cxs, cys = centroids_xy(geoms)
+    lons = lats = None
+    if utm_epsg == 4326:
+        lons, lats = cxs, cys
+    elif to_wgs is not None:
+        try:
+            lons, lats = to_wgs.transform(cxs, cys)
+        except Exception:
+            lons = lats = None
+
+    # core fields (tolerate missing props); missing values are written as blanks
+    props = [feat.get("properties", {}) or {} for feat in features]
+    areas = []
+    for p, geom in zip(props, geoms):
+        # area: use stored value if present, else compute
+        area_m2 = p.get("area_m2", None)
+        if area_m2 is None:
             try:
-                cx, cy = centroid_xy(geom)
+                area_m2 = float(geom.area)
             except Exception:
-                cx, cy = "", ""
-
-            # lon/lat via transform (optional)
-            lon = lat = ""
-            if to_wgs is not None and cx != "" and cy != "":
-                try:
-                    lon, lat = to_wgs.transform(cx, cy)
-                except Exception:
-                    lon = lat = ""
-
-            w.writerow([cell_id, row_idx, col_idx, area_m2, cx, cy, lon, lat])
-            rows_written += 1
+                area_m2 = np.nan
+        areas.append(area_m2)
+
+    # centroids in metric coords; non-finite values are written as blanks
+    cxs = np.where(np.isfinite(cxs), cxs, np.nan)
+    cys = np.where(np.isfinite(cys), cys, np.nan)
+    if lons is None:
+        lons = lats = np.full(len(features), np.nan)
+    else:
+        has_xy = np.isfinite(cxs) & np.isfinite(cys)
+        lons = np.where(has_xy & np.isfinite(lons), lons, np.nan)
+        lats = np.where(has_xy & np.isfinite(lats), lats, np.nan)
+
+    out = pd.DataFrame({
+        "cell_id": int_column([p.get("cell_id", i) for i, p in enumerate(props)]),
+        "row": int_column([p.get("row", None) for p in props]),
+        "col": int_column([p.get("col", None) for p in props]),
+        "area_m2": pd.to_numeric(pd.Series(areas, dtype=object), errors="coerce"),
+        "centroid_x_m": cxs,
+        "centroid_y_m": cys,
+        "lon": lons,
+        "lat": lats,
+    })
+    out.to_csv(OUT_PATH, index=False, encoding="utf-8", lineterminator="\r\n")  # same line endings as csv.writer
+    rows_written = len(out)
 
     print(f"Done. Wrote {rows_written} rows to {OUT_PATH}")
 